@@ -1,17 +1,42 @@
-import json
+import asyncio
+import base64
 import logging
-import secrets
+import os
 import sys
 
 import stripe
 import asyncpg
+import orjson
 from litestar import Litestar, Request, Response, get, post
+from litestar.exceptions import TooManyRequestsException
 from litestar.response import Redirect
 from litestar.status_codes import HTTP_404_NOT_FOUND
-from colorama import Fore
+from litestar.types import ASGIApp, Receive, Scope, Send
 
 import config
 
+REV_PRICES = {v: k for k, v in config.stripe_prices.items()}
+VALID_PRICES = frozenset(config.stripe_prices.values())
+WEBHOOK_MAX_BODY_SIZE = 1024 * 1024  # Stripe events are far smaller than this
+CHECKOUT_MAX_BODY_SIZE = 4096
+_b64encode = base64.urlsafe_b64encode
+CHECKOUT_BASE = {
+    'payment_method_types': ('card',),
+    'mode': 'subscription',
+    'success_url': 'https://overseer-bot.net/guilds',
+    'cancel_url': 'https://overseer-bot.net',
+}
+
+# Static responses are never mutated when sent, so one instance serves every request
+PING_RESPONSE = Response("Hello, world!", media_type="text/plain")
+SUCCESS_REDIRECT = Redirect('https://overseer-bot.net/guilds')
+CANCEL_REDIRECT = Redirect('https://overseer-bot.net')
+
+_USE_COLOR = sys.stdout.isatty()
+GREEN = '\x1b[32m' if _USE_COLOR else ''
+RED = '\x1b[31m' if _USE_COLOR else ''
+RESET = '\x1b[0m' if _USE_COLOR else ''
+
 stripe.api_key = config.stripe_key
 logging.basicConfig(
     level=logging.INFO,
@@ -19,18 +44,148 @@ logging.basicConfig(
     handlers=[logging.StreamHandler(sys.stdout)]
 )
 log = logging.getLogger('stripe_service')
-log.setLevel(logging.DEBUG)
+log.setLevel(getattr(config, 'log_level', logging.DEBUG))
 
 def handle_404(request: Request, exc: Exception) -> Response:
     return Response({'status_code': 404}, status_code=404)
 
 
+def concurrency_limit(limit: int):
+    # Shed load with a 429 once a route has `limit` requests in flight instead of queueing
+    def middleware_factory(app: ASGIApp) -> ASGIApp:
+        semaphore = asyncio.Semaphore(limit)
+
+        async def middleware(scope: Scope, receive: Receive, send: Send):
+            if semaphore.locked():
+                raise TooManyRequestsException()
+            async with semaphore:
+                await app(scope, receive, send)
+
+        return middleware
+
+    return middleware_factory
+
+
+class PatronConnection(asyncpg.Connection):
+    state_price_select: asyncpg.prepared_stmt.PreparedStatement
+    patrons_upsert: asyncpg.prepared_stmt.PreparedStatement
+    tier_update: asyncpg.prepared_stmt.PreparedStatement
+    patron_delete: asyncpg.prepared_stmt.PreparedStatement
+
+    async def prepare_statements(self):
+        self.state_price_select = await self.prepare('SELECT stripe_price FROM stripe_states WHERE state=$1')
+        self.patrons_upsert = await self.prepare(
+            """WITH s AS (
+                   SELECT user_id, guild_id FROM stripe_states WHERE state=$1 AND stripe_price=$2
+               )
+               INSERT INTO patrons (user_id, guild_id, customer_id, tier, subscribed_at)
+               SELECT s.user_id, s.guild_id, $3, $4, now() FROM s
+               ON CONFLICT (user_id, guild_id)
+               DO UPDATE SET customer_id=EXCLUDED.customer_id, tier=EXCLUDED.tier
+               RETURNING user_id
+            """
+        )
+        self.tier_update = await self.prepare('UPDATE patrons SET tier=$1 WHERE customer_id=$2')
+        self.patron_delete = await self.prepare('DELETE FROM patrons WHERE customer_id=$1 RETURNING user_id')
+
+
+class StateWriter:
+    # Group-commits stripe_states rows: every checkout waiting while a flush is in flight
+    # goes into the next single INSERT, and each caller still waits for its row to land
+    INSERT = """INSERT INTO stripe_states (user_id, guild_id, state, stripe_price)
+                SELECT user_id, guild_id, state, stripe_price
+                FROM json_to_recordset($1::json) AS x(user_id bigint, guild_id bigint, state text, stripe_price text)
+             """
+    # Errors caused by the contents of a row; orjson raises TypeError for ints wider than 64 bits
+    ROW_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError, TypeError)
+
+    def __init__(self, pool: asyncpg.Pool, max_batch: int = 100):
+        self.pool = pool
+        self.max_batch = max_batch
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(self._on_done)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._fail_pending()
+
+    def _on_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error('State writer stopped', exc_info=task.exception())
+        self._fail_pending()
+
+    def _fail_pending(self):
+        for _, fut in self._pending:
+            if not fut.done():
+                fut.set_exception(RuntimeError('State writer closed'))
+        self._pending.clear()
+
+    async def write(self, state: dict):
+        # A dead writer would never resolve the future, so refuse instead of hanging the checkout
+        if self._task is None or self._task.done():
+            raise RuntimeError('State writer is not running')
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((state, fut))
+        self._wakeup.set()
+        await fut
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                try:
+                    await self._flush(batch)
+                finally:
+                    # Only reached with unresolved futures when close() cancels us mid-flush
+                    for _, fut in batch:
+                        if not fut.done():
+                            fut.set_exception(RuntimeError('State writer closed'))
+
+    async def _flush(self, batch: list[tuple[dict, asyncio.Future]]):
+        try:
+            await self._insert(batch)
+        except self.ROW_ERRORS as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            # Retry row by row so one bad row only fails its own checkout
+            for item in batch:
+                await self._flush([item])
+        except Exception as e:
+            # Connection loss or timeouts would hit every row again, so fail the batch at once
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+        else:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_result(None)
+
+    async def _insert(self, batch: list[tuple[dict, asyncio.Future]]):
+        await self.pool.execute(self.INSERT, orjson.dumps([state for state, _ in batch]).decode())
+
+
 async def create_pool(app: Litestar) -> asyncpg.Pool:
+    # Binary jsonb is the JSON text prefixed with a version byte
     def _encode_jsonb(value):
-        return json.dumps(value)
+        return b'\x01' + orjson.dumps(value)
 
     def _decode_jsonb(value):
-        return json.loads(value)
+        return orjson.loads(value[1:])
 
     async def init(con):
         await con.set_type_codec(
@@ -38,15 +193,23 @@ async def create_pool(app: Litestar) -> asyncpg.Pool:
             schema='pg_catalog',
             encoder=_encode_jsonb,
             decoder=_decode_jsonb,
-            format='text',
+            format='binary',
         )
+        await con.prepare_statements()
 
     pool = await asyncpg.create_pool(
         config.postgresql,
         init=init,
-        command_timeout=60
+        connection_class=PatronConnection,
+        command_timeout=60,
+        min_size=getattr(config, 'pool_min_size', 5),
+        max_size=getattr(config, 'pool_max_size', 50),
+        max_inactive_connection_lifetime=getattr(config, 'pool_max_inactive_lifetime', 300),
+        statement_cache_size=getattr(config, 'statement_cache_size', 1024),
+        max_cached_statement_lifetime=getattr(config, 'max_cached_statement_lifetime', 0),
     )
-    assert pool is not None
+    if pool is None:
+        raise RuntimeError('pool creation returned None')
 
     if not getattr(app.state, 'pool', None):
         app.state.pool = pool
@@ -59,124 +222,184 @@ async def close_pool(app: Litestar):
         await app.state.pool.close()
 
 
+async def create_state_writer(app: Litestar):
+    app.state.state_writer = StateWriter(app.state.pool)
+    app.state.state_writer.start()
+
+
+async def close_state_writer(app: Litestar):
+    if getattr(app.state, 'state_writer', None) is not None:
+        await app.state.state_writer.close()
+
+
+async def create_stripe_client(app: Litestar):
+    # Async Stripe calls share one keep-alive httpx client per worker. Sync methods stay
+    # disabled so a blocking Stripe call can't slip onto the event loop unnoticed.
+    stripe.default_http_client = stripe.HTTPXClient(allow_sync_methods=False)
+
+
+async def close_stripe_client(app: Litestar):
+    if stripe.default_http_client is not None:
+        await stripe.default_http_client.close_async()
+
+
 @get("/")
-async def ping() -> str:
-    return "Hello, world!"
+async def ping() -> Response:
+    return PING_RESPONSE
 
 
 @get('/success')
 async def success(request: Request, session_id: str) -> Response:
-    return Redirect('https://overseer-bot.net/guilds')
+    return SUCCESS_REDIRECT
 
 
 @get('/cancel')
 async def cancel(request: Request, session_id: str) -> Response:
-    return Redirect('https://overseer-bot.net')
-
-
-@post("/webhook")
+    return CANCEL_REDIRECT
+
+
+async def _handle_checkout_completed(pool: asyncpg.Pool, sess: dict) -> Response | None:
+    if sess.get('payment_status') != 'paid':
+        return Response('Unpaid session', status_code=200)
+
+    ref = sess.get('client_reference_id')
+    if not ref:
+        return Response('Missing state', status_code=200)
+
+    async with pool.acquire() as conn:
+        # Sessions created before the price was stored in metadata need the state lookup
+        price = (sess.get('metadata') or {}).get('price')
+        if not price:
+            price = await conn.state_price_select.fetchval(ref)
+            if not price:
+                return Response('Orphan state', status_code=200)
+
+        tier = REV_PRICES.get(price)
+        if not tier:
+            return Response('Unknown price', status_code=200)
+
+        user_id = await conn.patrons_upsert.fetchval(ref, price, sess['customer'], tier)
+    if user_id is None:
+        return Response('Orphan state', status_code=200)
+    log.info(f'{GREEN}Payment complete for Discord user %s{RESET}', user_id)
+
+
+async def _handle_subscription_update(pool: asyncpg.Pool, sub: dict) -> Response | None:
+    if not sub['items']['data']:
+        return Response('No items', status_code=200)
+    price_id = sub['items']['data'][0]['price']['id']
+    if sub['status'] == 'canceled':
+        async with pool.acquire() as conn:
+            user_id = await conn.patron_delete.fetchval(sub['customer'])
+        log.info(f'{RED}Subscription for user %s expired{RESET}', user_id)
+    elif (tier := REV_PRICES.get(price_id)):
+        log.info(f'{GREEN}Payment complete for customer %s{RESET}', sub['customer'])
+        async with pool.acquire() as conn:
+            await conn.tier_update.fetch(tier, sub['customer'])
+
+
+async def _handle_subscription_deleted(pool: asyncpg.Pool, sub: dict) -> Response | None:
+    async with pool.acquire() as conn:
+        await conn.patron_delete.fetch(sub['customer'])
+
+
+EVENT_HANDLERS = {
+    'checkout.session.completed': _handle_checkout_completed,
+    'customer.subscription.created': _handle_subscription_update,
+    'customer.subscription.updated': _handle_subscription_update,
+    'customer.subscription.deleted': _handle_subscription_deleted,
+}
+
+
+@post(
+    "/webhook",
+    request_max_body_size=WEBHOOK_MAX_BODY_SIZE,
+    middleware=[concurrency_limit(getattr(config, 'webhook_concurrency', 128))],
+)
 async def webhook(request: Request) -> Response:
-    payload = await request.body()
     sig_header = request.headers.get("stripe-signature")
+    # Reject obviously malformed signatures before reading and hashing the payload
+    if not sig_header or "," not in sig_header or "t=" not in sig_header:
+        return Response("Invalid signature", status_code=400)
+
+    payload = await request.body()
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, config.signing_secret)
-        log.debug(f"Processed webhook event: {event.type}")
-        log.debug(str(event))
+        stripe.WebhookSignature.verify_header(
+            payload.decode(), sig_header, config.signing_secret, stripe.Webhook.DEFAULT_TOLERANCE
+        )
+        event = orjson.loads(payload)
+        log.debug("Processed webhook event: %s", event['type'])
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(str(event))
     except ValueError:
         return Response("Invalid payload", status_code=400)
     except stripe.SignatureVerificationError:
         return Response("Invalid signature", status_code=400)
 
-    rev_prices = {v: k for k, v in config.stripe_prices.items()}
-
-    async with request.app.state.pool.acquire() as conn:
-        async with conn.transaction():
-            match event.type:
-                case 'checkout.session.completed':
-                    sess = event.data.object
-                    if sess.get('payment_status') != 'paid':
-                        return Response('Unpaid session', status_code=200)
-
-                    ref = sess.get('client_reference_id')
-                    if not ref:
-                        return Response('Missing state', status_code=200)
-
-                    state = await conn.fetchrow(
-                        'SELECT user_id, guild_id, stripe_price FROM stripe_states WHERE state=$1',
-                        ref,
-                    )
-                    if not state:
-                        return Response('Orphan state', status_code=200)
-
-                    tier = rev_prices.get(state['stripe_price'])
-                    if not tier:
-                        return Response('Unknown price', status_code=200)
-
-                    log.info(f'{Fore.GREEN}Payment complete for Discord user {state['user_id']}{Fore.RESET}')
-                    await conn.execute(
-                        """INSERT INTO patrons (user_id, guild_id, customer_id, tier, subscribed_at)
-                           VALUES($1, $2, $3, $4, now())
-                           ON CONFLICT (user_id, guild_id)
-                           DO UPDATE SET customer_id=EXCLUDED.customer_id, tier=EXCLUDED.tier
-                        """, state['user_id'], state['guild_id'], sess['customer'], tier
-                    )
-
-                case 'customer.subscription.updated' | 'customer.subscription.created':
-                    sub = event.data.object
-                    if not sub['items']['data']:
-                        return Response('No items', status_code=200)
-                    price_id = sub['items']['data'][0]['price']['id']
-                    if sub['status'] == 'canceled':
-                        user_id = await request.app.state.pool.fetchval(
-                            'DELETE FROM patrons WHERE customer_id=$1 RETURNING user_id', sub['customer']
-                        )
-                        log.info(f'{Fore.RED}Subscription for user %s expired{Fore.RESET}', user_id)
-                    elif (tier := rev_prices.get(price_id)):
-                        log.info(f'{Fore.GREEN}Payment complete for customer {sub['customer']}{Fore.RESET}')
-                        await conn.execute('UPDATE patrons SET tier=$1 WHERE customer_id=$2', tier, sub['customer'])
-
-                case 'customer.subscription.deleted':
-                    sub = event.data.object
-                    await conn.execute('DELETE FROM patrons WHERE customer_id=$1', sub['customer'])
-
-                case _:
-                    log.debug('Unhandled event type %s', event.type)
-
-        return Response('Success', status_code=200)
-
-
-@post("/checkout")
+    handler = EVENT_HANDLERS.get(event['type'])
+    if handler is None:
+        log.debug('Unhandled event type %s', event['type'])
+    elif (response := await handler(request.app.state.pool, event['data']['object'])) is not None:
+        return response
+
+    return Response('Success', status_code=200)
+
+
+def _parse_id(value) -> int | None:
+    # Discord snowflakes as JSON ints or numeric strings; must fit a Postgres bigint
+    if isinstance(value, str):
+        if not (value.isascii() and value.isdigit()):
+            return None
+        value = int(value)
+    elif isinstance(value, bool) or not isinstance(value, int):
+        return None
+    return value if 0 < value < 2**63 else None
+
+
+@post(
+    "/checkout",
+    request_max_body_size=CHECKOUT_MAX_BODY_SIZE,
+    middleware=[concurrency_limit(getattr(config, 'checkout_concurrency', 64))],
+)
 async def checkout(request: Request) -> Response:
-    body = await request.json()
+    try:
+        content_length = int(request.headers.get('content-length', '0'))
+    except ValueError:
+        content_length = 0
+    if not 0 < content_length <= CHECKOUT_MAX_BODY_SIZE:
+        return Response({'error': 'Invalid body'}, status_code=400)
+
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        return Response({'error': 'Invalid body'}, status_code=400)
+    if not isinstance(body, dict):
+        return Response({'error': 'Invalid body'}, status_code=400)
+
     user_id = body.get('user_id')
     guild_id = body.get('guild_id')
     price = body.get('price')
     if None in (user_id, guild_id, price):
         log.debug('Request missing required parameter')
         return Response({'error': 'Missing user_id'}, status_code=400)
-    if price not in config.stripe_prices.values():
+    user_id = _parse_id(user_id)
+    guild_id = _parse_id(guild_id)
+    if user_id is None or guild_id is None:
+        return Response({'error': 'Invalid user_id or guild_id'}, status_code=400)
+    if not isinstance(price, str) or price not in VALID_PRICES:
         return Response({'error': 'Invalid price'}, status_code=400)
 
-    session_id = secrets.token_urlsafe(16)
-    assert isinstance(session_id, str)
+    session_id = _b64encode(os.urandom(16)).rstrip(b'=').decode('ascii')
     log.debug('Creating checkout session for user ID %s with session ID %s', user_id, session_id)
     try:
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[
-                {
-                    'price': price,
-                    'quantity': 1,
-                }
-            ],
-            mode='subscription',
-            success_url='https://overseer-bot.net/guilds',
-            cancel_url='https://overseer-bot.net',
+        session = await stripe.checkout.Session.create_async(
+            **CHECKOUT_BASE,
+            line_items=({'price': price, 'quantity': 1},),
             client_reference_id=session_id,
+            metadata={'price': price},
         )
-        await request.app.state.pool.execute(
-            'INSERT INTO stripe_states (user_id, guild_id, state, stripe_price) VALUES ($1, $2, $3, $4)',
-            int(user_id), int(guild_id), session_id, price
+        await request.app.state.state_writer.write(
+            {'user_id': user_id, 'guild_id': guild_id, 'state': session_id, 'stripe_price': price}
         )
         log.debug('Successfully stored state for session')
         return Response({'url': session.url})
@@ -188,7 +411,7 @@ async def checkout(request: Request) -> Response:
 app = Litestar(
     [ping, checkout, webhook, success],
     path='/shop',
-    on_startup=[create_pool],
-    on_shutdown=[close_pool],
+    on_startup=[create_pool, create_state_writer, create_stripe_client],
+    on_shutdown=[close_state_writer, close_pool, close_stripe_client],
     exception_handlers={HTTP_404_NOT_FOUND: handle_404}
 )
@@ -0,0 +1,6 @@
+from uvicorn.workers import UvicornWorker
+
+
+class UvloopWorker(UvicornWorker):
+    # Fail loudly instead of silently falling back to asyncio/h11 if either is missing
+    CONFIG_KWARGS = {'loop': 'uvloop', 'http': 'httptools'}